@@ -1,8 +1,123 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 from io import BytesIO
-from thefuzz import process
+from rapidfuzz import fuzz, process, utils
+
+# Only these columns are read from the upload; everything else is dropped at parse time
+USED_COLUMNS = ['User Name', 'HQ Code', "Student Doctor's Name", "Student Doctor's City", "Student Doctor's State",
+                "Teacher's Doctor's Name", 'Entry Date']
+# Text columns that are repeatedly grouped, filtered and counted
+CATEGORY_COLUMNS = ['User Name', 'HQ Code', "Student Doctor's State", "Student Doctor's City",
+                    "Student Doctor's Name", "Teacher's Doctor's Name"]
+FILTER_COLUMNS = ['User Name', "Student Doctor's State"]
+# Row-level tables larger than this are truncated in the browser and offered as a download instead
+MAX_DISPLAY_ROWS = 1000
+# Parsed uploads kept in memory at once
+UPLOAD_CACHE_ENTRIES = 4
+# Per-selection results are only reused while an upload is active, so keep the caches bounded
+SELECTION_CACHE_ENTRIES = 32
+
+
+# Cached on the distinct names alone, so re-uploads with the same SBM roster skip the fuzzy pass
+@st.cache_data(show_spinner=False)
+def match_sbm_names(unique_sbms):
+    standard_sbms = np.asarray(unique_sbms[:75], dtype=object)
+    canonical = np.asarray(unique_sbms, dtype=object)
+
+    # Names in the standard list map to themselves; only the remainder needs fuzzy scoring
+    candidates = unique_sbms[75:]
+    if candidates:
+        # Score every remaining SBM name against the standard list in one batched call
+        scores = process.cdist(candidates, standard_sbms, scorer=fuzz.WRatio,
+                               processor=utils.default_process, score_cutoff=95,
+                               dtype=np.uint8, workers=-1)
+        best_idx = scores.argmax(axis=1)
+        best_score = scores[np.arange(len(candidates)), best_idx]
+        canonical[75:] = np.where(best_score > 95, standard_sbms[best_idx], canonical[75:])
+    return canonical
+
+
+# Keyed on the uploader's file_id; the raw bytes are passed unhashed so reruns don't re-digest the file.
+# Each upload gets a new file_id, so only the few most recent parsed frames are kept.
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def load_data(file_id, file_name, _file_bytes):
+    def is_used(col):
+        return str(col).strip() in USED_COLUMNS
+
+    if file_name.endswith(".csv"):
+        # The pyarrow parser only takes a list of columns, so resolve it from the header row first
+        header = pd.read_csv(BytesIO(_file_bytes), nrows=0).columns
+        df = pd.read_csv(BytesIO(_file_bytes), engine="pyarrow", usecols=[col for col in header if is_used(col)])
+    else:
+        try:
+            df = pd.read_excel(BytesIO(_file_bytes), engine="calamine", usecols=is_used)
+        except ImportError:
+            df = pd.read_excel(BytesIO(_file_bytes), engine="openpyxl", usecols=is_used)
+
+    df.columns = df.columns.str.strip()
+    df = df.dropna(subset=["Student Doctor's Name", "Teacher's Doctor's Name"])
+
+    # Workbooks usually arrive with real datetimes; only text dates need parsing
+    if 'Entry Date' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['Entry Date']):
+        df['Entry Date'] = pd.to_datetime(df['Entry Date'], errors='coerce')
+
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+
+    # Categories come back sorted, so each distinct SBM name is matched exactly once
+    sbm_codes = df['User Name'].cat.codes.to_numpy()
+    canonical = match_sbm_names(tuple(df['User Name'].cat.categories))
+
+    # Recode the rows through the category mapping instead of re-hashing every name
+    canonical_sbms = pd.Index(canonical).unique().sort_values()
+    recode = canonical_sbms.get_indexer(canonical)
+    df['User Name'] = pd.Categorical.from_codes(np.where(sbm_codes >= 0, recode[sbm_codes], -1),
+                                                categories=canonical_sbms)
+
+    # Sidebar option lists only change with the upload, so build them once alongside the data.
+    # Categories are already sorted and NaN-free, so no column scan or sort is needed.
+    filter_options = {col: df[col].cat.categories.tolist() for col in FILTER_COLUMNS}
+    if 'Entry Date' in df.columns:
+        filter_options['Entry Date'] = [df['Entry Date'].min(), df['Entry Date'].max()]
+    return df, filter_options
+
+
+# The builders below are keyed on filter_key (upload + sidebar selections) rather than
+# on the filtered frame itself, so tab switches and unrelated widgets reuse the results.
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def build_execution(filter_key, _df, by, assigned):
+    # Response counts and unique students come out of the same grouping pass
+    grouped = _df.groupby(by, observed=True)["Student Doctor's Name"].agg(['size', 'nunique'])
+    execution = grouped['nunique'].rename('Unique Student Doctors').reset_index()
+    execution['Execution %'] = round((execution['Unique Student Doctors'] / assigned) * 100, 2)
+    return execution, grouped['size'].sort_values(ascending=False)
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def build_trend(filter_key, _df):
+    return _df.groupby(_df['Entry Date'].dt.floor('D')).size().reset_index(name='Responses')
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def build_city_crosstab(filter_key, _df):
+    return _df.groupby(['User Name', "Student Doctor's City"], observed=True).size().unstack(fill_value=0)
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def sbm_summary_xlsx(filter_key, _execution_df):
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': {'in_memory': True}}) as writer:
+        _execution_df.to_excel(writer, index=False, sheet_name='SBM Summary')
+    return output.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def duplicate_teachers_csv(filter_key, _multi_teachers):
+    return _multi_teachers.to_csv(index=False).encode()
+
 
 # Page settings
 st.set_page_config(layout="wide")
@@ -31,53 +146,41 @@ uploaded_file = st.file_uploader("📁 Upload Teachers' Day Excel/CSV File", typ
 
 if uploaded_file:
     with st.spinner("Processing uploaded file... please wait ⏳"):
-        if uploaded_file.name.endswith(".csv"):
-            df = pd.read_csv(uploaded_file)
-        else:
-            df = pd.read_excel(uploaded_file)
-
-        df.columns = df.columns.str.strip()
-        df.dropna(subset=["Student Doctor's Name", "Teacher's Doctor's Name"], inplace=True)
-
-        unique_sbms = df['User Name'].unique()
-        standard_sbms = list(set(unique_sbms))[:75]
-
-        def match_sbm(name):
-            match, score = process.extractOne(name, standard_sbms)
-            return match if score > 95 else name
-
-        df['User Name'] = df['User Name'].apply(match_sbm)
-
-        if 'Entry Date' in df.columns:
-            df['Entry Date'] = pd.to_datetime(df['Entry Date'], errors='coerce')
+        df_raw, filter_options = load_data(uploaded_file.file_id, uploaded_file.name, uploaded_file.getvalue())
 
         st.sidebar.header("🔍 Filters")
-        sbm_filter = st.sidebar.multiselect("Filter by SBM", sorted(df['User Name'].unique()))
-        state_filter = st.sidebar.multiselect("Filter by State", sorted(df["Student Doctor's State"].dropna().unique()))
-        if 'Entry Date' in df.columns:
-            min_date, max_date = df['Entry Date'].min(), df['Entry Date'].max()
-            date_range = st.sidebar.date_input("Filter by Date", [min_date, max_date])
+        sbm_filter = st.sidebar.multiselect("Filter by SBM", filter_options['User Name'])
+        state_filter = st.sidebar.multiselect("Filter by State", filter_options["Student Doctor's State"])
+        if 'Entry Date' in df_raw.columns:
+            date_range = st.sidebar.date_input("Filter by Date", filter_options['Entry Date'])
         else:
             date_range = None
 
+        # Combine every active filter into one mask and slice the cached frame once;
+        # all tabs below read the filtered view in df
+        masks = []
         if sbm_filter:
-            df = df[df['User Name'].isin(sbm_filter)]
+            masks.append(df_raw['User Name'].isin(sbm_filter).to_numpy())
         if state_filter:
-            df = df[df["Student Doctor's State"].isin(state_filter)]
+            masks.append(df_raw["Student Doctor's State"].isin(state_filter).to_numpy())
         if date_range and len(date_range) == 2:
-            df = df[(df['Entry Date'] >= pd.to_datetime(date_range[0])) & (df['Entry Date'] <= pd.to_datetime(date_range[1]))]
+            entry_dates = df_raw['Entry Date'].to_numpy()
+            masks.append((entry_dates >= np.datetime64(date_range[0])) & (entry_dates <= np.datetime64(date_range[1])))
+        df = df_raw.loc[np.logical_and.reduce(masks)] if masks else df_raw
+        filter_key = (uploaded_file.file_id, tuple(sbm_filter), tuple(state_filter), tuple(date_range or ()))
+
+        # One pass per column feeds the KPIs, charts and tables below
+        assigned_per_sbm = 100
+        execution_df, sbm_counts = build_execution(filter_key, df, 'User Name', assigned_per_sbm)
+        teacher_mentions = df["Teacher's Doctor's Name"].value_counts(sort=False)
+        teacher_mentions = teacher_mentions[teacher_mentions > 0]  # categorical counts include filtered-out values
 
         total_entries = len(df)
         unique_students = df["Student Doctor's Name"].nunique()
-        unique_teachers = df["Teacher's Doctor's Name"].nunique()
+        unique_teachers = len(teacher_mentions)
         duplicate_teacher_mentions = total_entries - unique_teachers
-        sbm_count = df['User Name'].nunique()
+        sbm_count = len(sbm_counts)
         avg_responses_per_sbm = round(total_entries / sbm_count, 2)
-
-        assigned_per_sbm = 100
-        execution_df = df.groupby('User Name')["Student Doctor's Name"].nunique().reset_index()
-        execution_df.columns = ['User Name', 'Unique Student Doctors']
-        execution_df['Execution %'] = round((execution_df['Unique Student Doctors'] / assigned_per_sbm) * 100, 2)
         avg_execution = round(execution_df['Execution %'].mean(), 2)
 
         tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
@@ -106,7 +209,7 @@ if uploaded_file:
             st.subheader("📊 Charts")
 
             with st.expander("🟢 Pie Chart: SBM-wise Contribution"):
-                sbm_pie = df['User Name'].value_counts().reset_index()
+                sbm_pie = sbm_counts.reset_index()
                 sbm_pie.columns = ['User Name', 'Responses']
                 fig_pie = px.pie(sbm_pie, names='User Name', values='Responses', hole=0.4,
                                  color_discrete_sequence=px.colors.sequential.Tealgrn)
@@ -115,7 +218,7 @@ if uploaded_file:
 
             with st.expander("📈 Line Chart: Daily Trend"):
                 if 'Entry Date' in df.columns:
-                    trend = df.groupby(df['Entry Date'].dt.date).size().reset_index(name='Responses')
+                    trend = build_trend(filter_key, df)
                     fig_line = px.line(trend, x='Entry Date', y='Responses', markers=True,
                                        color_discrete_sequence=['#117864'])
                     fig_line.update_traces(mode='lines+markers', hovertemplate='Date: %{x}<br>Responses: %{y}')
@@ -124,7 +227,8 @@ if uploaded_file:
 
             with st.expander("🏙️ Bar Chart: Top Cities"):
                 if "Student Doctor's City" in df.columns:
-                    city_chart = df["Student Doctor's City"].value_counts().reset_index().head(10)
+                    city_counts = df["Student Doctor's City"].value_counts(sort=False)
+                    city_chart = city_counts[city_counts > 0].nlargest(10).reset_index()
                     city_chart.columns = ['City', 'Responses']
                     fig_city = px.bar(city_chart, x='City', y='Responses', color='Responses',
                                       color_continuous_scale='Tealgrn')
@@ -134,51 +238,72 @@ if uploaded_file:
 
         with tab2:
             st.header("🔢 SBM Execution Summary")
-            execution_df['Rank'] = execution_df['Execution %'].rank(ascending=False).astype(int)
-            st.dataframe(execution_df.sort_values("Execution %", ascending=False), use_container_width=True, height=400)
+            # Descending rank from the inverse of a stable argsort; tied SBMs keep table order
+            rank = np.empty(len(execution_df), dtype=np.int64)
+            rank[np.argsort(-execution_df['Execution %'].to_numpy(), kind='stable')] = np.arange(1, len(execution_df) + 1)
+            execution_df['Rank'] = rank
+            st.dataframe(execution_df.sort_values("Rank"), use_container_width=True, height=400)
 
             st.subheader("⚠️ Low Performing SBMs (<60%)")
             st.dataframe(execution_df[execution_df['Execution %'] < 60], use_container_width=True)
 
-            def to_excel(df):
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df.to_excel(writer, index=False, sheet_name='SBM Summary')
-                return output.getvalue()
-
-            excel = to_excel(execution_df)
-            st.download_button("📥 Download Summary", data=excel, file_name="sbm_summary.xlsx")
+            download_format = st.radio("Download format", ["CSV", "Excel"], horizontal=True)
+            if download_format == "CSV":
+                st.download_button("📥 Download Summary", data=execution_df.to_csv(index=False).encode(),
+                                   file_name="sbm_summary.csv", mime="text/csv")
+            else:
+                st.download_button("📥 Download Summary", data=sbm_summary_xlsx(filter_key, execution_df),
+                                   file_name="sbm_summary.xlsx",
+                                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
         with tab3:
             st.header("👨‍🏫 Top Teachers")
-            teacher_counts = df["Teacher's Doctor's Name"].value_counts().reset_index()
+            # Partial selection of the top 10 instead of sorting every teacher's count
+            teacher_counts = teacher_mentions.nlargest(10).reset_index()
             teacher_counts.columns = ['Teacher Name', 'Mentions']
-            st.dataframe(teacher_counts.head(10), use_container_width=True)
-            fig = px.bar(teacher_counts.head(10), x='Mentions', y='Teacher Name', orientation='h',
+            st.dataframe(teacher_counts, use_container_width=True)
+            fig = px.bar(teacher_counts, x='Mentions', y='Teacher Name', orientation='h',
                          color='Mentions', color_continuous_scale='Tealgrn')
             fig.update_layout(paper_bgcolor='#f4f6f9')
             st.plotly_chart(fig, use_container_width=True)
 
         with tab4:
             st.header("📋 Duplicate Teacher Doctors")
-            multi_teachers = df[df.duplicated("Teacher's Doctor's Name", keep=False)]
-            st.dataframe(multi_teachers[["Teacher's Doctor's Name", "Student Doctor's Name", "Student Doctor's City"]],
-                         use_container_width=True)
+            # Reuse the mention counts from the summary instead of re-hashing the column
+            repeat_teachers = teacher_mentions.index[teacher_mentions > 1]
+            multi_teachers = df.loc[df["Teacher's Doctor's Name"].isin(repeat_teachers),
+                                    ["Teacher's Doctor's Name", "Student Doctor's Name", "Student Doctor's City"]]
+            st.dataframe(multi_teachers.head(MAX_DISPLAY_ROWS), use_container_width=True)
+            if len(multi_teachers) > MAX_DISPLAY_ROWS:
+                st.caption(f"Showing {MAX_DISPLAY_ROWS:,} of {len(multi_teachers):,} duplicate rows")
+                st.download_button("📥 Download All Duplicates", data=duplicate_teachers_csv(filter_key, multi_teachers),
+                                   file_name="duplicate_teachers.csv", mime="text/csv")
 
         with tab5:
             st.header("📊 Advanced Visuals")
 
+            if "Student Doctor's City" in df.columns:
+                # One counting pass feeds both the heatmap and the stacked bar
+                city_ct = build_city_crosstab(filter_key, df)
+
             st.subheader("🔥 Heatmap: SBM vs City")
             if "Student Doctor's City" in df.columns:
-                heat_df = df.pivot_table(index='User Name', columns="Student Doctor's City",
-                                         values="Student Doctor's Name", aggfunc='count', fill_value=0)
+                # Limit the heatmap to the busiest SBMs and cities so the figure stays small
+                top_k = st.slider("Top SBMs / cities in heatmap", min_value=5, max_value=100, value=30, step=5)
+                top_sbms = city_ct.sum(axis=1).nlargest(top_k).index
+                top_cities = city_ct.sum(axis=0).nlargest(top_k).index
+                heat_df = city_ct.loc[city_ct.index.isin(top_sbms), city_ct.columns.isin(top_cities)]
+                if heat_df.shape != city_ct.shape:
+                    st.caption(f"Showing the top {heat_df.shape[0]} of {city_ct.shape[0]} SBMs and "
+                               f"top {heat_df.shape[1]} of {city_ct.shape[1]} cities by responses")
                 fig_heat = px.imshow(heat_df, aspect='auto', color_continuous_scale='YlGnBu')
                 fig_heat.update_layout(paper_bgcolor='#f4f6f9')
                 st.plotly_chart(fig_heat, use_container_width=True)
 
             st.subheader("📊 Stacked Bar: SBM & City")
             if "Student Doctor's City" in df.columns:
-                stacked_df = df.groupby(['User Name', "Student Doctor's City"]).size().reset_index(name='Count')
+                stacked_df = city_ct.stack().rename('Count').reset_index()
+                stacked_df = stacked_df[stacked_df['Count'] > 0]
                 fig_stacked = px.bar(stacked_df, x='User Name', y='Count', color="Student Doctor's City")
                 fig_stacked.update_layout(paper_bgcolor='#f4f6f9')
                 st.plotly_chart(fig_stacked, use_container_width=True)
@@ -186,9 +311,7 @@ if uploaded_file:
         with tab6:
             st.header("📌 RBM Summary & KPI Target (100 Doctors)")
             if "HQ Code" in df.columns:
-                rbm_df = df.groupby('HQ Code')["Student Doctor's Name"].nunique().reset_index()
-                rbm_df.columns = ['RBM', 'Unique Student Doctors']
-                rbm_df['Execution %'] = round((rbm_df['Unique Student Doctors'] / assigned_per_sbm) * 100, 2)
+                rbm_df = build_execution(filter_key, df, 'HQ Code', assigned_per_sbm)[0].rename(columns={'HQ Code': 'RBM'})
                 st.dataframe(rbm_df.sort_values('Execution %', ascending=False), use_container_width=True)
 
                 fig_rbm = px.bar(rbm_df, x='RBM', y='Execution %', color='Execution %',